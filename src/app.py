@@ -9,21 +9,23 @@ This app allows users to:
 5. Generate 3D visualizations with audio reactivity
 """
 
+import io
 import os
 import tempfile
 import streamlit as st
-import librosa
-import librosa.display
 import numpy as np
-import matplotlib.pyplot as plt
-import torch
+import pandas as pd
+import altair as alt
+import soundfile as sf
 import time
 import json
-import base64
 import hashlib  # For creating cache keys
 import shutil   # For file operations
+import string
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from separation import separate_audio, mix_stems
 
 # Configure page
 st.set_page_config(
@@ -40,49 +42,215 @@ os.makedirs(DEV_CACHE_DIR, exist_ok=True)
 TEMP_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "temp")
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+# Downsampled stems for the 3D visualization are written under Streamlit's static folder
+# (server.enableStaticServing) so the browser fetches them by URL instead of base64 data URLs
+VISUALIZATION_DIR = os.path.join(os.path.dirname(__file__), "static", "visualization")
+os.makedirs(VISUALIZATION_DIR, exist_ok=True)
+
+# Verbose per-stem diagnostics while preparing the visualization
+DEBUG = bool(os.getenv("STEMVIZ_DEBUG"))
+
+# soxr quality for the visualizer's audio; it only feeds FFT-based visuals, so the
+# high quality mode is plenty and far faster than kaiser_best
+VISUALIZATION_RESAMPLE_QUALITY = os.getenv("STEMVIZ_RESAMPLE_QUALITY", "HQ")
+
+# Number of min/max pairs drawn per waveform; the chart is only ~1000px wide
+WAVEFORM_POINTS = 1000
+
+# Waveform colors for each stem
+STEM_COLORS = {
+    "vocals": "#ff9900",
+    "drums": "#ff0000",
+    "bass": "#0000ff",
+    "other": "#00cc00"
+}
+DEFAULT_COLOR = "#1f77b4"
+
+# MIME subtypes for upload extensions whose subtype differs from the extension
+AUDIO_MIME_TYPES = {
+    "m4a": "audio/mp4",
+    "aac": "audio/aac",
+    "mp3": "audio/mpeg",
+    "ogg": "audio/ogg",
+    "flac": "audio/flac",
+    "wav": "audio/wav"
+}
+
 # Add a function to clean up old temp files
+@st.cache_resource(show_spinner=False)
 def cleanup_temp_files(max_age_hours=24):
-    """Clean up temporary files older than the specified age"""
+    """
+    Remove session and visualization directories older than the specified age.
+    Live sessions clean up their own TemporaryDirectory, so this only catches
+    leftovers from crashed or killed processes; it runs once per process, with
+    one stat per directory.
+    """
     try:
-        current_time = time.time()
-        max_age_seconds = max_age_hours * 60 * 60
+        cutoff = time.time() - max_age_hours * 60 * 60
         
-        for root, dirs, files in os.walk(TEMP_DIR):
-            for file in files:
-                file_path = os.path.join(root, file)
-                file_age = current_time - os.path.getmtime(file_path)
-                
-                if file_age > max_age_seconds:
-                    try:
-                        os.remove(file_path)
-                    except Exception as e:
-                        print(f"Failed to remove old temp file {file_path}: {e}")
+        for temp_root in (TEMP_DIR, VISUALIZATION_DIR):
+            for entry in os.scandir(temp_root):
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        if entry.is_dir():
+                            shutil.rmtree(entry.path, ignore_errors=True)
+                        else:
+                            os.remove(entry.path)
+                except Exception as e:
+                    print(f"Failed to remove old temp entry {entry.path}: {e}")
     except Exception as e:
         print(f"Error during temp cleanup: {e}")
 
 # Caching functions
-@st.cache_data
-def cached_separate_audio(input_path, output_dir, model_name, device):
-    """Cache the stem separation to avoid reprocessing during development"""
-    return separate_audio(input_path, output_dir, model_name, device)
+@st.cache_resource
+def cuda_available():
+    """Probe for CUDA once per process instead of on every rerun"""
+    # torch is imported lazily so the page renders before the heavy import is paid
+    import torch
+    return torch.cuda.is_available()
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def get_demucs_model(model_name, device):
+    """Load Demucs weights once per (model, device) and share them across reruns and sessions"""
+    from demucs.pretrained import get_model
+    model = get_model(model_name)
+    model.to(device)
+    model.eval()
+    return model
+
+def file_sample_hash(path, window=1 << 20):
+    """
+    Hash the file size plus only the first and last window bytes of the file, so
+    identical uploads share cache entries regardless of their temp path and the
+    cost doesn't grow with file size
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        digest.update(file_size.to_bytes(8, "little"))
+        digest.update(f.read(window))
+        # Seek to the tail, without overlapping the head for small files
+        f.seek(max(file_size - window, window))
+        digest.update(f.read(window))
+    return digest.hexdigest()
 
-def get_cached_stems(input_path, model_name):
+@st.cache_resource
+def get_separation_generations():
+    """
+    Per (file hash, model, device) counter, bumped when a cached separation's stems have been
+    deleted so the next call misses that entry and recomputes instead of returning dead paths
     """
-    Try to get cached stems for the given input file and model.
+    return {}
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def cached_separate_audio(file_hash, model_name, device, generation, _input_path, _output_dir):
+    """
+    Cache the stem separation to avoid reprocessing identical audio.
+    Keyed on the file contents, model, device and generation; the underscore-prefixed
+    paths are excluded from the key since they differ for every upload of the same file.
+    """
+    # separation pulls in torch, torchaudio and demucs, so only import it when actually separating
+    from separation import separate_audio
     
-    Returns:
-        Dictionary of stem paths if cached, None otherwise
+    return separate_audio(_input_path, _output_dir, model_name, device,
+                          model=get_demucs_model(model_name, device))
+
+def link_stems(stem_paths, input_path, output_dir):
+    """
+    Hardlink (or copy across filesystems) stems into this upload's output directory,
+    laid out the way separate_audio would have written them
+    """
+    output_folder = os.path.join(output_dir, os.path.splitext(os.path.basename(input_path))[0])
+    os.makedirs(output_folder, exist_ok=True)
+    
+    linked_paths = {}
+    for stem_name, stem_path in stem_paths.items():
+        linked_path = os.path.join(output_folder, f"{stem_name}.wav")
+        if os.path.abspath(stem_path) != os.path.abspath(linked_path):
+            if os.path.exists(linked_path):
+                os.remove(linked_path)
+            # A missing source raises FileNotFoundError from both, which marks the entry stale
+            try:
+                os.link(stem_path, linked_path)
+            except OSError:
+                shutil.copy2(stem_path, linked_path)
+        linked_paths[stem_name] = linked_path
+    return linked_paths
+
+def separate_with_cache(file_hash, model_name, device, input_path, output_dir):
+    """
+    Run the cached separation and give this upload its own links to the stems, since a
+    cache hit points into the session that first separated the file and is removed with it
+    """
+    generations = get_separation_generations()
+    generation_key = (file_hash, model_name, device)
+    generation = generations.get(generation_key, 0)
+    stem_paths = cached_separate_audio(file_hash, model_name, device, generation, input_path, output_dir)
+    try:
+        return link_stems(stem_paths, input_path, output_dir)
+    except FileNotFoundError:
+        # The cached stems are gone; move past the stale entry so it recomputes and stays fresh
+        generations[generation_key] = generation + 1
+        return cached_separate_audio(file_hash, model_name, device, generation + 1, input_path, output_dir)
+
+@st.cache_resource
+def get_separation_executor():
     """
-    # Create a unique key based on the input file and model
-    file_name = os.path.basename(input_path)
-    file_size = os.path.getsize(input_path)
+    Single worker thread shared across reruns and sessions, so Demucs runs off the
+    script thread and separations are queued instead of competing for the CPU/GPU.
+    """
+    return ThreadPoolExecutor(max_workers=1)
+
+@st.cache_resource
+def get_preload_executor():
+    """Separate worker for model preloads, so they never queue ahead of a separation"""
+    return ThreadPoolExecutor(max_workers=1)
+
+def log_preload_error(future):
+    """Report a failed background model load instead of dropping the exception"""
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Model preload failed: {future.exception()}")
+
+@st.fragment(run_every=0.5)
+def show_separation_progress():
+    """Poll the running separation and rerun the whole app once it has finished"""
+    job = st.session_state.get("separation_job")
+    if job is None:
+        return
     
-    # Simple cache key based on filename, size and model
-    cache_key = f"{file_name}_{file_size}_{model_name}"
-    cache_key_hash = hashlib.md5(cache_key.encode()).hexdigest()
+    future = job["future"]
+    if not future.done():
+        # Demucs doesn't report progress, so track elapsed time against the size-based estimate
+        elapsed_time = time.time() - job["start_time"]
+        progress = min(elapsed_time / max(job["estimated_time"], 1), 0.95)
+        st.progress(progress, text=f"Separating stems... {elapsed_time:.0f} of ~{job['estimated_time']:.0f} seconds")
+        return
+    
+    # Hand the result to the main script run, which can render it outside this fragment
+    del st.session_state["separation_job"]
+    try:
+        st.session_state["separation_result"] = (job, future.result(), None)
+    except Exception as e:
+        st.session_state["separation_result"] = (job, None, e)
+    st.rerun()
+
+def stem_cache_key(file_hash, model_name):
+    """
+    Build the dev stem cache key from the input's file_sample_hash and the model.
+    The filename is left out so a renamed copy of the same track still hits the cache.
+    """
+    cache_key = f"{file_hash}_{model_name}"
+    return hashlib.blake2b(cache_key.encode(), digest_size=16).hexdigest()
+
+def get_cached_stems(cache_key):
+    """
+    Try to get cached stems for the given cache key (see stem_cache_key).
     
+    Returns:
+        Dictionary of stem paths if cached, None otherwise
+    """
     # Check if we have this in cache
-    cache_dir = os.path.join(DEV_CACHE_DIR, cache_key_hash)
+    cache_dir = os.path.join(DEV_CACHE_DIR, cache_key)
     
     if os.path.exists(cache_dir):
         st.info("Using cached stems for faster development")
@@ -99,64 +267,257 @@ def get_cached_stems(input_path, model_name):
     
     return None
 
-def save_to_cache(input_path, model_name, stem_paths):
+def save_to_cache(cache_key, stem_paths):
     """Save stems to cache for faster development"""
-    # Create a unique key based on the input file and model
-    file_name = os.path.basename(input_path)
-    file_size = os.path.getsize(input_path)
-    
-    # Simple cache key based on filename, size and model
-    cache_key = f"{file_name}_{file_size}_{model_name}"
-    cache_key_hash = hashlib.md5(cache_key.encode()).hexdigest()
-    
     # Create cache directory
-    cache_dir = os.path.join(DEV_CACHE_DIR, cache_key_hash)
+    cache_dir = os.path.join(DEV_CACHE_DIR, cache_key)
     os.makedirs(cache_dir, exist_ok=True)
     
-    # Copy stems to cache
+    # Hardlink stems into the cache, falling back to a copy across filesystems
     for stem_name, stem_path in stem_paths.items():
         cache_path = os.path.join(cache_dir, f"{stem_name}.wav")
-        shutil.copy2(stem_path, cache_path)
+        if os.path.exists(cache_path):
+            os.chmod(cache_path, 0o644)
+            os.remove(cache_path)
+        # A hardlink shares its inode with the live session stem, so it stays writable;
+        # separation.save_audio replaces stems rather than rewriting them, leaving the entry intact
+        try:
+            os.link(stem_path, cache_path)
+        except OSError:
+            shutil.copy2(stem_path, cache_path)
+            # Only a standalone copy can be protected without affecting the session's file
+            os.chmod(cache_path, 0o444)
     
     st.success(f"Stems cached for faster development")
 
 # Define functions for visualization
-def plot_waveform(audio_path, title, color="#1f77b4"):
-    """Plot waveform for audio file"""
+@st.cache_data(show_spinner=False)
+def cached_waveform_envelope(audio_source, mtime):
+    """
+    Compute a min/max envelope of the audio, streaming the file block by block
+    so the full waveform never has to be decoded into memory.
+    audio_source is a file path or in-memory WAV bytes. mtime is only part of
+    the cache key so the envelope is rebuilt when a file changes.
+    
+    Returns:
+        Tuple of (lows, highs, duration in seconds)
+    """
     try:
-        y, sr = librosa.load(audio_path, sr=None)
-        fig, ax = plt.subplots(figsize=(10, 2))
-        librosa.display.waveshow(y, sr=sr, ax=ax, color=color)
-        ax.set_title(title)
-        ax.set_xlabel("Time (s)")
-        ax.set_ylabel("Amplitude")
-        return fig
+        if isinstance(audio_source, bytes):
+            audio_source = io.BytesIO(audio_source)
+        with sf.SoundFile(audio_source) as f:
+            step = max(1, f.frames // WAVEFORM_POINTS)
+            lows = [np.empty(0, dtype=np.float32)]
+            highs = [np.empty(0, dtype=np.float32)]
+            # Read many envelope columns per block and reduce them in one vectorized call,
+            # rather than paying Python overhead for every column
+            for block in f.blocks(blocksize=step * 64, dtype="float32", always_2d=True):
+                mono = block.mean(axis=1)
+                full = len(mono) - len(mono) % step
+                if full:
+                    columns = mono[:full].reshape(-1, step)
+                    lows.append(columns.min(axis=1))
+                    highs.append(columns.max(axis=1))
+                # Only the last block can end in a partial column
+                if full < len(mono):
+                    lows.append(mono[full:].min(keepdims=True))
+                    highs.append(mono[full:].max(keepdims=True))
+            duration = f.frames / f.samplerate
+        return np.concatenate(lows), np.concatenate(highs), duration
+    except RuntimeError:
+        # libsndfile can't read some formats (e.g. m4a), fall back to a full librosa decode
+        import librosa
+        y, sr = librosa.load(audio_source, sr=None)
+        step = max(1, len(y) // WAVEFORM_POINTS)
+        blocks = y[:step * (len(y) // step)].reshape(-1, step)
+        return blocks.min(axis=1), blocks.max(axis=1), len(y) / sr
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def read_audio_bytes(audio_path, mtime):
+    """
+    Read an audio file's bytes once per file version for st.audio, instead of
+    having Streamlit re-read the file from disk on every rerun
+    """
+    with open(audio_path, "rb") as f:
+        return f.read()
+
+def plot_waveform(audio_source, title, color=DEFAULT_COLOR, mtime=None):
+    """
+    Plot waveform for an audio file path or in-memory WAV bytes.
+    The envelope is drawn client-side as a filled Altair band, so no image is rendered on the server.
+    Pass mtime if the caller already stat'ed the file to skip another stat call.
+    """
+    try:
+        # In-memory audio is keyed by its content, so it has no mtime
+        if mtime is None and not isinstance(audio_source, bytes):
+            mtime = os.path.getmtime(audio_source)
+        lows, highs, duration = cached_waveform_envelope(audio_source, mtime)
+        envelope = pd.DataFrame({
+            "time": np.linspace(0, duration, len(lows)),
+            "min": lows,
+            "max": highs
+        })
+        # Fill between the min and max of each column, like a classic waveform view
+        chart = alt.Chart(envelope, title=title, height=200).mark_area(color=color).encode(
+            x=alt.X("time:Q", title="Time (s)"),
+            y=alt.Y("min:Q", title="Amplitude"),
+            y2="max:Q"
+        )
+        st.altair_chart(chart, use_container_width=True)
     except Exception as e:
         st.error(f"Error plotting waveform: {e}")
-        # Create empty plot as fallback
-        fig, ax = plt.subplots(figsize=(10, 2))
-        ax.set_title(f"{title} (Failed to load)")
-        ax.text(0.5, 0.5, f"Error: {str(e)}", ha='center', va='center')
-        return fig
+
+def mixed_blocks(paths, blocksize=65536):
+    """
+    Yield the sum of the given audio files block by block, so only one block per
+    stem is ever decoded at a time. The files are expected to share a length,
+    channel count and sample rate, as Demucs stems do.
+    """
+    files = [sf.SoundFile(path) for path in paths]
+    try:
+        stem_blocks = (f.blocks(blocksize=blocksize, dtype="float32", always_2d=True) for f in files)
+        for blocks in zip(*stem_blocks):
+            mixed = blocks[0].copy()
+            for block in blocks[1:]:
+                np.add(mixed, block, out=mixed)
+            yield mixed
+    finally:
+        for f in files:
+            f.close()
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def cached_mix(stem_files, selected_stems):
+    """
+    Sum and normalize the selected stems into WAV bytes.
+    Keyed on every stem's (name, path, mtime) plus the sorted selection, so repeating
+    a selection of unchanged stems returns the previous mix.
+    """
+    stem_lookup = {stem_name: path for stem_name, path, _ in stem_files}
+    paths = [stem_lookup[stem_name] for stem_name in selected_stems]
+    info = sf.info(paths[0])
+    
+    # First pass finds the peak of the mix so it can be normalized to prevent clipping
+    peak = 0.0
+    for mixed in mixed_blocks(paths):
+        peak = max(peak, float(np.abs(mixed).max(initial=0.0)))
+    gain = 0.9 / peak if peak > 0 else 1.0
+    
+    # Second pass scales and encodes the mix as WAV without touching the disk
+    buffer = io.BytesIO()
+    with sf.SoundFile(buffer, "w", samplerate=info.samplerate, channels=info.channels,
+                      format="WAV", subtype="PCM_16") as out:
+        for mixed in mixed_blocks(paths):
+            mixed *= gain
+            out.write(mixed)
+    return buffer.getvalue()
 
 def create_custom_mix(stem_paths, selected_stems):
-    """Create a custom mix from selected stems"""
+    """
+    Create a custom mix from selected stems entirely in memory.
+    
+    Returns:
+        WAV file contents as bytes, or None if nothing could be mixed
+    """
     if not selected_stems:
         return None
     
-    # Create a temporary file for the mix in our custom temp directory
     try:
-        # Create a unique filename for the mix
-        mix_filename = f"custom_mix_{int(time.time())}.wav"
-        # Use our custom temp directory
-        temp_file = os.path.join(TEMP_DIR, mix_filename)
-        
-        # Use our existing mix_stems function
-        return mix_stems(stem_paths, temp_file, selected_stems)
+        stem_files = tuple(
+            (stem_name, path, os.path.getmtime(path))
+            for stem_name, path in stem_paths.items()
+        )
+        # Sort so the cache key doesn't depend on the order the stems were ticked
+        return cached_mix(stem_files, tuple(sorted(selected_stems)))
     except Exception as e:
         st.error(f"Error creating custom mix: {e}")
         return None
 
+@st.cache_resource
+def load_visualization_template():
+    """
+    Read the visualizer's HTML, CSS and JS once and inline the CSS and JS into the HTML.
+    The files are static, so reruns only fill in the per-visualization data.
+    
+    Returns:
+        string.Template with $stem_data, $stem_paths and $app_config placeholders
+    """
+    web_dir = os.path.join(os.path.dirname(__file__), "web")
+    # Escape literal $ (used in the JS) so only our placeholders are substituted
+    with open(os.path.join(web_dir, "index.html"), "r") as f:
+        html_content = f.read().replace("$", "$$")
+    with open(os.path.join(web_dir, "css", "style.css"), "r") as f:
+        css_content = f.read().replace("$", "$$")
+    with open(os.path.join(web_dir, "js", "visualizer.js"), "r") as f:
+        js_content = f.read().replace("$", "$$")
+    
+    # Placeholders for the stems data element, the stemPaths variable and the app config
+    html_content = html_content.replace('<body>', '<body>${stem_data}')
+    html_content = html_content.replace("const stemPaths = {};", "const stemPaths = ${stem_paths};")
+    html_content = html_content.replace('</body>', '${app_config}</body>')
+    
+    # Embed the CSS and JS directly
+    html_content = html_content.replace('<link rel="stylesheet" href="css/style.css">', f'<style>{css_content}</style>')
+    html_content = html_content.replace('<script src="js/visualizer.js"></script>', f'<script>{js_content}</script>')
+    
+    # Add loading indicator
+    html_content = html_content.replace('<div id="canvas-container"></div>', 
+                                      '<div id="canvas-container"></div><div id="loading-indicator">Loading audio stems...</div>')
+    return string.Template(html_content)
+
+def resample_for_visualization(path, target_sr, max_duration, block_seconds=10):
+    """
+    Stream an audio file through one continuous soxr resampler, downmixing to mono,
+    so long files are neither fully decoded nor re-opened per chunk.
+    Only the first max_duration seconds are read.
+    
+    Returns:
+        Mono float32 array at target_sr
+    """
+    import soxr
+    
+    with sf.SoundFile(path) as f:
+        frames = min(f.frames, int(f.samplerate * max_duration))
+        resampler = soxr.ResampleStream(f.samplerate, target_sr, 1, dtype="float32",
+                                        quality=VISUALIZATION_RESAMPLE_QUALITY)
+        
+        # Preallocate the output; the resampler can emit a sample more than the exact ratio
+        out = np.empty(int(np.ceil(frames * target_sr / f.samplerate)) + 1, dtype=np.float32)
+        filled = 0
+        
+        def append(chunk):
+            nonlocal filled
+            n = min(len(chunk), len(out) - filled)
+            out[filled:filled + n] = chunk[:n]
+            filled += n
+        
+        blocks = f.blocks(blocksize=f.samplerate * block_seconds, frames=frames,
+                          dtype="float32", always_2d=True)
+        for block in blocks:
+            append(resampler.resample_chunk(block.mean(axis=1)))
+        append(resampler.resample_chunk(np.empty(0, dtype=np.float32), last=True))
+    return out[:filled]
+
+def prepare_visualization_stem(path, output_path, target_sr, max_duration):
+    """
+    Downsample one stem for the visualizer and save it as a 16-bit WAV.
+    Runs on a worker thread, so it must not call any Streamlit functions.
+    
+    Returns:
+        Tuple of (original duration in seconds, original sample rate, downsampled duration in seconds)
+    """
+    # Get audio file info without loading the entire file
+    file_info = sf.info(path)
+    
+    # Stream the file once through a single resampler instead of re-opening it per chunk
+    y = resample_for_visualization(path, target_sr, max_duration)
+    
+    # Write under a temporary name and swap it in, so a page already fetching this file
+    # never reads it half-written
+    partial_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.part"
+    sf.write(partial_path, y, target_sr, format='WAV', subtype='PCM_16')
+    os.replace(partial_path, output_path)
+    return file_info.duration, file_info.samplerate, len(y) / target_sr
+
 def create_3d_visualization(stem_paths):
     """
     Create a 3D visualization of audio stems using Three.js
@@ -170,186 +531,137 @@ def create_3d_visualization(stem_paths):
         st.error("No stem paths provided for visualization")
         return
     
-    st.info(f"Creating visualization with {len(stem_paths)} stems: {', '.join(stem_paths.keys())}")
+    # Create a static directory for this upload's set of stems' downsampled audio. Stems served
+    # from the dev cache have the same paths in every session, so the upload is part of the key
+    # to keep sessions from writing, or removing, each other's files
+    stems_key = hashlib.md5("|".join([st.session_state.get("upload_id", "")] + sorted(stem_paths.values())).encode()).hexdigest()
+    visualization_temp_dir = os.path.join(VISUALIZATION_DIR, stems_key)
+    
+    # Reuse the page built on a previous rerun if the stems haven't changed and
+    # their downsampled files haven't been cleaned up since
+    visualization_key = tuple(
+        (stem_name, path, os.path.getmtime(path) if os.path.exists(path) else None)
+        for stem_name, path in sorted(stem_paths.items())
+    )
+    cached_visualization = st.session_state.get("visualization_html")
+    if (cached_visualization and cached_visualization[0] == visualization_key
+            and os.path.isdir(visualization_temp_dir)):
+        st.components.v1.html(cached_visualization[1], height=700)
+        return
+    
+    if DEBUG:
+        st.info(f"Creating visualization with {len(stem_paths)} stems: {', '.join(stem_paths.keys())}")
     
     # Create URLs for each stem that can be accessed by JavaScript
     stem_urls = {}
     
-    # Create a temp directory for downsampled audio
-    visualization_temp_dir = os.path.join(TEMP_DIR, "visualization")
     os.makedirs(visualization_temp_dir, exist_ok=True)
     
+    # Each upload owns one visualization directory: replace the previous one, and remove
+    # this one along with the upload's TemporaryDirectory when the session ends
+    previous_visualization_dir = st.session_state.get("visualization_dir")
+    if previous_visualization_dir != visualization_temp_dir:
+        if previous_visualization_dir:
+            shutil.rmtree(previous_visualization_dir, ignore_errors=True)
+        st.session_state["visualization_dir"] = visualization_temp_dir
+        weakref.finalize(st.session_state["temp_dir"], shutil.rmtree, visualization_temp_dir, True)
+    
     # Configurable parameters for downsampling - with higher quality
     target_sr = 32000      # Improved sample rate (was 22050)
     max_duration = 600     # Max duration in seconds (10 minutes)
-    chunk_size = 60        # Process in 60-second chunks if needed
     
+    # One collapsible status line instead of a message per step; details only with STEMVIZ_DEBUG
+    status = st.status(f"Preparing visualization for {len(stem_paths)} stems...", expanded=False)
+    use_chunking = False
+    duration = 0
     try:
-        for stem_name, path in stem_paths.items():
-            st.info(f"Processing {stem_name} stem from {path}")
-            
-            # Verify the file exists and is readable
-            if not os.path.exists(path):
-                st.error(f"Stem file not found: {path}")
-                continue
-            
-            # Check file size
-            file_size_mb = os.path.getsize(path) / (1024 * 1024)
-            st.info(f"Stem file size: {file_size_mb:.2f} MB")
-            
-            try:
-                # Get audio file info without loading the entire file
-                import soundfile as sf
-                file_info = sf.info(path)
-                original_duration = file_info.duration
-                original_sr = file_info.samplerate
+        # Downsample the stems in parallel; decoding, resampling and writing release the GIL.
+        # The workers only touch files, all Streamlit calls stay on the script thread
+        with ThreadPoolExecutor(max_workers=max(1, min(4, len(stem_paths)))) as executor:
+            jobs = {}
+            for stem_name, path in stem_paths.items():
+                # Verify the file exists and is readable
+                if not os.path.exists(path):
+                    status.error(f"Stem file not found: {path}")
+                    continue
                 
-                st.info(f"Original audio: {original_duration:.2f} seconds, {original_sr}Hz")
+                # Create static file for downsampled audio
+                temp_file_path = os.path.join(visualization_temp_dir, f"{stem_name}.wav")
+                jobs[stem_name] = (temp_file_path, executor.submit(
+                    prepare_visualization_stem, path, temp_file_path, target_sr, max_duration
+                ))
+            
+            for stem_name, (temp_file_path, future) in jobs.items():
+                try:
+                    original_duration, original_sr, stem_duration = future.result()
+                except Exception as e:
+                    status.error(f"Error processing {stem_name} stem: {e}")
+                    if DEBUG:
+                        status.exception(e)
+                    continue
                 
-                # Create a plan for downsampling based on file size and duration
+                # Longer audio is truncated to max_duration while streaming
                 if original_duration > max_duration:
-                    st.warning(f"Audio is longer than {max_duration} seconds, will use chunked processing")
                     use_chunking = True
-                else:
-                    use_chunking = False
-                
-                # Process in chunks or all at once
-                if use_chunking:
-                    # Calculate chunk parameters
-                    num_chunks = min(int(original_duration / chunk_size) + 1, 
-                                    int(max_duration / chunk_size))
-                    
-                    # Create a list to store chunk data
-                    all_audio = []
-                    
-                    # Process each chunk
-                    for i in range(num_chunks):
-                        chunk_start = i * chunk_size
-                        chunk_end = min((i + 1) * chunk_size, max_duration)
-                        
-                        if chunk_start >= max_duration:
-                            break
-                            
-                        st.info(f"Processing chunk {i+1}/{num_chunks}: {chunk_start}-{chunk_end} seconds")
-                        
-                        # Load just this chunk with target sample rate
-                        # Use quality settings for librosa.load
-                        y_chunk, sr = librosa.load(
-                            path, 
-                            sr=target_sr,
-                            offset=chunk_start,
-                            duration=chunk_end-chunk_start,
-                            res_type='kaiser_best'  # Higher quality resampling
-                        )
-                        
-                        # Add to our collection
-                        all_audio.append(y_chunk)
-                    
-                    # Combine chunks
-                    y = np.concatenate(all_audio)
-                    sr = target_sr
-                    st.info(f"Successfully processed {len(all_audio)} chunks")
-                    
-                else:
-                    # Load with target sample rate directly
-                    y, sr = librosa.load(path, sr=target_sr, res_type='kaiser_best')
-                
-                # Debug audio data
-                st.info(f"Loaded audio: {len(y)} samples, {sr}Hz, {len(y)/sr:.2f} seconds")
-                
-                # Further reduce audio size for very long songs by decimation
-                if len(y) > target_sr * max_duration:
-                    st.warning(f"Audio too long, reducing from {len(y)/sr:.2f}s to {max_duration}s")
-                    y = y[:int(target_sr * max_duration)]
+                    status.warning(f"{stem_name}: audio is longer than {max_duration} seconds, only the first {max_duration} seconds will be visualized")
+                duration = stem_duration
                 
-                # Create temporary file for downsampled audio
-                temp_file_path = os.path.join(visualization_temp_dir, f"{stem_name}_downsampled.wav")
+                if DEBUG:
+                    downsampled_size_mb = os.path.getsize(temp_file_path) / (1024 * 1024)
+                    status.info(f"{stem_name}: {original_duration:.2f} seconds at {original_sr}Hz, downsampled to "
+                                f"{stem_duration:.2f} seconds at {target_sr}Hz in {temp_file_path} ({downsampled_size_mb:.2f} MB)")
                 
-                # Save downsampled audio with higher quality settings
-                sf.write(temp_file_path, y, sr, format='WAV', subtype='PCM_16')
-                
-                # Report the new file size
-                downsampled_size_mb = os.path.getsize(temp_file_path) / (1024 * 1024)
-                st.info(f"Downsampled file saved to {temp_file_path} ({downsampled_size_mb:.2f} MB)")
-                
-                # Now read the much smaller file for the data URL
-                with open(temp_file_path, "rb") as file:
-                    audio_bytes = file.read()
-                
-                # Create a data URL for the audio file
-                audio_b64 = base64.b64encode(audio_bytes).decode()
-                data_url = f"data:audio/wav;base64,{audio_b64}"
-                stem_urls[stem_name] = data_url
-                
-                # Report the encoded size
-                encoded_size_mb = len(data_url) / (1024 * 1024)
-                st.info(f"Data URL created for {stem_name}, size: {encoded_size_mb:.2f} MB)")
-                
-            except Exception as e:
-                st.error(f"Error processing {stem_name} stem: {e}")
-                import traceback
-                st.error(f"Traceback: {traceback.format_exc()}")
+                # Relative static URL; the component iframe resolves it against the app's URL.
+                # Streamlit serves .wav static files as text/plain, which is fine since the
+                # visualizer fetches raw bytes and decodes them with decodeAudioData
+                stem_urls[stem_name] = f"app/static/visualization/{stems_key}/{stem_name}.wav"
         
     except Exception as e:
+        status.update(label="Visualization preparation failed", state="error", expanded=True)
         st.error(f"Error preparing audio for visualization: {e}")
         import traceback
         st.error(f"Traceback: {traceback.format_exc()}")
         st.info("Try using shorter audio files or enable chunking for visualization.")
         return
     
+    if stem_urls:
+        status.update(label=f"Visualization ready ({len(stem_urls)} stems)", state="complete")
+    else:
+        status.update(label="Visualization preparation failed", state="error", expanded=True)
+    
     # Check if we have any valid stems after processing
     if not stem_urls:
         st.error("No stems could be processed for visualization")
         return
     
-    # Read the HTML template
-    html_path = os.path.join(os.path.dirname(__file__), "web", "index.html")
-    
     try:
-        with open(html_path, "r") as f:
-            html_content = f.read()
-        
         # Replace the placeholder with actual stem paths
         stem_paths_json = json.dumps(stem_urls)
         
         # Add a hidden element with the stems data
         stem_data_element = f'<div id="stem-paths" data-stems=\'{stem_paths_json}\' style="display:none;"></div>'
-        html_content = html_content.replace('<body>', f'<body>{stem_data_element}')
-        
-        # Also set the JavaScript variable for backward compatibility
-        html_content = html_content.replace("const stemPaths = {};", f"const stemPaths = {stem_paths_json};")
-        
-        # Embed the CSS directly
-        css_path = os.path.join(os.path.dirname(__file__), "web", "css", "style.css")
-        with open(css_path, "r") as f:
-            css_content = f.read()
-        
-        html_content = html_content.replace('<link rel="stylesheet" href="css/style.css">', f'<style>{css_content}</style>')
-        
-        # Embed the JS directly
-        js_path = os.path.join(os.path.dirname(__file__), "web", "js", "visualizer.js")
-        with open(js_path, "r") as f:
-            js_content = f.read()
-        
-        html_content = html_content.replace('<script src="js/visualizer.js"></script>', f'<script>{js_content}</script>')
-        
-        # Add loading indicator
-        html_content = html_content.replace('<div id="canvas-container"></div>', 
-                                          '<div id="canvas-container"></div><div id="loading-indicator">Loading audio stems...</div>')
         
         # Add custom configurations to pass to JavaScript
         config = {
             "audioConfig": {
                 "chunkMode": use_chunking,
                 "sampleRate": target_sr,
-                "duration": len(y)/sr if 'y' in locals() and 'sr' in locals() else 0
+                "duration": duration
             }
         }
         
         config_json = json.dumps(config)
-        html_content = html_content.replace('</body>', f'<script>const appConfig = {config_json};</script></body>')
+        
+        # Fill every placeholder in a single pass over the template; the stemPaths
+        # variable is also set for backward compatibility
+        html_content = load_visualization_template().substitute(
+            stem_data=stem_data_element,
+            stem_paths=stem_paths_json,
+            app_config=f'<script>const appConfig = {config_json};</script>'
+        )
         
         # Display using st.components.html
+        st.session_state["visualization_html"] = (visualization_key, html_content)
         st.components.v1.html(html_content, height=700)
     except Exception as e:
         st.error(f"Error creating 3D visualization: {e}")
@@ -386,12 +698,58 @@ def show_format_info():
         If you encounter format issues, try converting your file to WAV using another tool first.
         """)
 
+@st.fragment
+def show_custom_mix(stem_paths):
+    """
+    Custom mix section. Runs as a fragment so toggling stems or creating a mix
+    only reruns this section instead of redrawing every stem above it.
+    """
+    st.subheader("Create Custom Mix")
+    st.write("Select stems to include in your custom mix:")
+    
+    # Checkboxes for each stem
+    selected_stems = []
+    cols = st.columns(len(stem_paths))
+    for i, (stem_name, path) in enumerate(stem_paths.items()):
+        with cols[i]:
+            if st.checkbox(stem_name.capitalize(), value=True, key=f"include_{stem_name}"):
+                selected_stems.append(stem_name)
+    
+    if st.button("Create Mix", key="create_mix_button"):
+        if selected_stems:
+            with st.spinner("Creating custom mix..."):
+                mix_bytes = create_custom_mix(stem_paths, selected_stems)
+                if mix_bytes:
+                    st.session_state["mix_bytes"] = mix_bytes
+                    st.success("Custom mix created!")
+                else:
+                    st.error("Failed to create mix. Check the logs for details.")
+    
+    # Display custom mix if available
+    if "mix_bytes" in st.session_state:
+        st.subheader("Custom Mix")
+        try:
+            st.audio(st.session_state["mix_bytes"], format="audio/wav")
+        except Exception as e:
+            st.warning(f"Could not play custom mix: {e}")
+    
+        st.write("Custom Mix Waveform:")
+        plot_waveform(st.session_state["mix_bytes"], "Custom Mix", "#9467bd")
+    
+        # Add download button for the mix
+        st.download_button(
+            label="Download Custom Mix",
+            data=st.session_state["mix_bytes"],
+            file_name="custom_mix.wav",
+            mime="audio/wav"
+        )
+
 # Streamlit app
 def main():
     st.title("Audio Stem Separator & Visualizer")
     st.write("Upload an audio file to separate it into stems and visualize the waveforms.")
     
-    # Clean up old temp files on startup
+    # Clean up orphaned temp files once, when the server process starts
     cleanup_temp_files()
     
     # Add model explanations
@@ -402,25 +760,62 @@ def main():
     uploaded_file = st.file_uploader("Choose an audio file", type=["mp3", "wav", "m4a", "ogg", "flac"])
     
     if uploaded_file is not None:
-        # Create a unique temp subdirectory for this session to avoid conflicts
-        session_id = str(int(time.time())) + "_" + str(hash(uploaded_file.name) % 10000)
-        session_temp_dir = os.path.join(TEMP_DIR, session_id)
-        os.makedirs(session_temp_dir, exist_ok=True)
+        # Only set up a temp directory when a new file is uploaded; reruns reuse it
+        if st.session_state.get("upload_id") != uploaded_file.file_id:
+            # Remove the previous upload's files and any results derived from them
+            previous_temp_dir = st.session_state.pop("temp_dir", None)
+            if previous_temp_dir:
+                try:
+                    previous_temp_dir.cleanup()
+                except OSError:
+                    pass
+            st.session_state.pop("stem_paths", None)
+            st.session_state.pop("mix_bytes", None)
+            previous_visualization_dir = st.session_state.pop("visualization_dir", None)
+            if previous_visualization_dir:
+                shutil.rmtree(previous_visualization_dir, ignore_errors=True)
+            
+            # Forget the previous upload's separation; a job that has already started can't be
+            # stopped, so remove the output directory it recreates once it finishes
+            previous_job = st.session_state.pop("separation_job", None)
+            st.session_state.pop("separation_result", None)
+            if previous_job and not previous_job["future"].cancel():
+                previous_job["future"].add_done_callback(
+                    lambda _, path=previous_job["temp_dir"]: shutil.rmtree(path, ignore_errors=True)
+                )
+            
+            # Create a unique temp subdirectory for this session; it is removed when the
+            # session state is dropped or the process exits
+            session_temp = tempfile.TemporaryDirectory(prefix="stemviz_", dir=TEMP_DIR)
+            session_temp_dir = session_temp.name
+            
+            # Stream uploaded file to disk in 1 MB chunks instead of copying it into a bytes object first
+            uploaded_file.seek(0)
+            with open(os.path.join(session_temp_dir, uploaded_file.name), "wb") as f:
+                shutil.copyfileobj(uploaded_file, f, length=1 << 20)
+            
+            st.session_state["temp_dir"] = session_temp
+            st.session_state["upload_id"] = uploaded_file.file_id
+            # Sample the file once; the hash keys both the dev cache and the in-process separation cache
+            st.session_state["file_hash"] = file_sample_hash(os.path.join(session_temp_dir, uploaded_file.name))
+            
+            extension = Path(uploaded_file.name).suffix[1:].lower() or "wav"
+            st.session_state["audio_mime"] = AUDIO_MIME_TYPES.get(extension, f"audio/{extension}")
         
+        session_temp_dir = st.session_state["temp_dir"].name
         input_path = os.path.join(session_temp_dir, uploaded_file.name)
         output_dir = os.path.join(session_temp_dir, "stems")
+        audio_format = st.session_state["audio_mime"]
         
-        # Save uploaded file to disk
-        with open(input_path, "wb") as f:
-            f.write(uploaded_file.getvalue())
-        
-        # Display file info
-        file_size_mb = os.path.getsize(input_path) / (1024 * 1024)
+        # Display file info; one stat call gives both the size and the mtime used in cache keys
+        input_stat = os.stat(input_path)
+        file_size_mb = input_stat.st_size / (1024 * 1024)
         st.info(f"Uploaded file: {uploaded_file.name} ({file_size_mb:.2f} MB)")
         
-        # Try to display audio player
+        # Try to display audio player; the upload is already in memory, so play it from there
+        # rather than re-reading the file from disk (identical bytes are served once)
         try:
-            st.audio(input_path, format=f"audio/{os.path.splitext(uploaded_file.name)[1][1:]}")
+            st.audio(uploaded_file, format=audio_format)
         except Exception as e:
             st.warning(f"Could not preview audio: {e} - Processing will still be attempted.")
         
@@ -441,10 +836,11 @@ def main():
             )
         
         with col2:
+            gpu_available = cuda_available()
             use_gpu = st.checkbox("Use GPU (if available)", 
-                                value=torch.cuda.is_available(),
-                                disabled=not torch.cuda.is_available())
-            if not torch.cuda.is_available() and use_gpu:
+                                value=gpu_available,
+                                disabled=not gpu_available)
+            if not gpu_available and use_gpu:
                 st.info("GPU not detected, using CPU instead.")
                 use_gpu = False
         
@@ -458,11 +854,30 @@ def main():
         # Add "Use Cached Stems" option for development
         use_cached = st.checkbox("Use cached stems if available (for development)", value=True)
         
-        if st.button("Separate Stems"):
+        file_hash = st.session_state["file_hash"]
+        cache_key = stem_cache_key(file_hash, model_options[model_name])
+        separation_running = "separation_job" in st.session_state
+        
+        # Start loading the selected model's weights in the background while the user finishes picking
+        # options, unless Demucs is already busy for this session or the dev cache will skip it
+        preload_key = (model_options[model_name], device)
+        skip_preload = separation_running or (use_cached and os.path.isdir(os.path.join(DEV_CACHE_DIR, cache_key)))
+        if not skip_preload and st.session_state.get("preloaded_model") != preload_key:
+            # Only the current selection is worth loading; drop a superseded load that hasn't started
+            previous_preload = st.session_state.pop("preload_future", None)
+            if previous_preload:
+                previous_preload.cancel()
+            preload_future = get_preload_executor().submit(get_demucs_model, *preload_key)
+            preload_future.add_done_callback(log_preload_error)
+            st.session_state["preload_future"] = preload_future
+            st.session_state["preloaded_model"] = preload_key
+        
+        if st.button("Separate Stems", disabled=separation_running):
+            
             # Try to get cached stems first if enabled
             cached_stems = None
             if use_cached:
-                cached_stems = get_cached_stems(input_path, model_options[model_name])
+                cached_stems = get_cached_stems(cache_key)
             
             if cached_stems:
                 # Use cached stems
@@ -470,45 +885,43 @@ def main():
                 st.session_state["stem_paths"] = stem_paths
                 st.success("Using cached stems for faster development!")
             else:
-                # No cached stems, do the normal processing
-                # Create a progress bar
-                progress_bar = st.progress(0, text="Initializing...")
-                status_text = st.empty()
+                # No cached stems, run Demucs on the worker thread so the UI stays responsive
+                st.session_state["separation_job"] = {
+                    "future": get_separation_executor().submit(
+                        separate_with_cache,
+                        file_hash,
+                        model_options[model_name],
+                        device,
+                        input_path,
+                        output_dir
+                    ),
+                    "cache_key": cache_key,
+                    "upload_id": uploaded_file.file_id,
+                    "temp_dir": session_temp_dir,
+                    "start_time": time.time(),
+                    "estimated_time": estimated_time
+                }
+                separation_running = True
+        
+        if separation_running:
+            show_separation_progress()
+        
+        # Handle a separation that finished on the worker thread
+        if "separation_result" in st.session_state:
+            job, stem_paths, error = st.session_state.pop("separation_result")
+            if job["upload_id"] != st.session_state["upload_id"]:
+                # Finished after a new file was uploaded; its stems belong to the old track
+                pass
+            elif error is not None:
+                st.error(f"Error during separation: {str(error)}")
+                st.info("Try a different model or file format if the issue persists.")
+            elif stem_paths:
+                # Save to cache for future use
+                save_to_cache(job["cache_key"], stem_paths)
                 
-                try:
-                    # Track start time
-                    start_time = time.time()
-                    
-                    # Update status
-                    status_text.text("Loading model...")
-                    progress_bar.progress(10, text="Loading Demucs model...")
-                    
-                    # Use our cached separate_audio function
-                    status_text.text("Processing audio...")
-                    
-                    # Process in stages to update progress
-                    stem_paths = cached_separate_audio(
-                        input_path, 
-                        output_dir, 
-                        model_options[model_name], 
-                        device
-                    )
-                    
-                    # Save to cache for future use
-                    save_to_cache(input_path, model_options[model_name], stem_paths)
-                    
-                    # Update with completion
-                    elapsed_time = time.time() - start_time
-                    progress_bar.progress(100, text="Processing complete!")
-                    status_text.text(f"Completed in {elapsed_time:.1f} seconds.")
-                    
-                    if stem_paths:
-                        st.session_state["stem_paths"] = stem_paths
-                        st.success(f"Stems separated successfully in {elapsed_time:.1f} seconds!")
-                except Exception as e:
-                    st.error(f"Error during separation: {str(e)}")
-                    st.info("Try a different model or file format if the issue persists.")
-                    progress_bar.empty()
+                elapsed_time = time.time() - job["start_time"]
+                st.session_state["stem_paths"] = stem_paths
+                st.success(f"Stems separated successfully in {elapsed_time:.1f} seconds!")
         
         # Display stems if available
         if "stem_paths" in st.session_state:
@@ -524,40 +937,32 @@ def main():
                 with selected_tab[0]:
                     st.write("Original audio file")
                     try:
-                        st.audio(input_path, format=f"audio/{os.path.splitext(uploaded_file.name)[1][1:]}")
+                        st.audio(uploaded_file, format=audio_format)
                     except Exception as e:
                         st.warning(f"Could not play original audio: {e}")
                     
                     st.write("Waveform:")
-                    st.pyplot(plot_waveform(input_path, "Original Audio"))
+                    plot_waveform(input_path, "Original Audio", mtime=input_stat.st_mtime)
                 
                 # Stems tab
                 with selected_tab[1]:
                     # Create sub-tabs for each stem
-                    stem_tabs = list(stem_paths.keys())
-                    stem_selected_tab = st.tabs(stem_tabs)
+                    stem_names = tuple(stem_paths)
+                    stem_selected_tab = st.tabs(stem_names)
                     
                     # Display each stem in its tab
-                    for i, stem_name in enumerate(stem_paths.keys()):
-                        with stem_selected_tab[i]:
+                    for stem_name, stem_tab in zip(stem_names, stem_selected_tab):
+                        with stem_tab:
                             st.write(f"{stem_name.capitalize()} audio")
                             try:
-                                st.audio(stem_paths[stem_name], format="audio/wav")
+                                stem_path = stem_paths[stem_name]
+                                st.audio(read_audio_bytes(stem_path, os.path.getmtime(stem_path)), format="audio/wav")
                             except Exception as e:
                                 st.warning(f"Could not play {stem_name} stem: {e}")
                             
                             st.write("Waveform:")
-                            
-                            # Use different colors for different stems
-                            colors = {
-                                "vocals": "#ff9900",
-                                "drums": "#ff0000",
-                                "bass": "#0000ff",
-                                "other": "#00cc00"
-                            }
-                            color = colors.get(stem_name, "#1f77b4")
-                            
-                            st.pyplot(plot_waveform(stem_paths[stem_name], f"{stem_name.capitalize()} Waveform", color))
+                            color = STEM_COLORS.get(stem_name, DEFAULT_COLOR)
+                            plot_waveform(stem_paths[stem_name], f"{stem_name.capitalize()} Waveform", color)
                 
                 # 3D Visualization tab
                 with selected_tab[2]:
@@ -568,47 +973,7 @@ def main():
                     create_3d_visualization(stem_paths)
                 
                 # Custom mix section
-                st.subheader("Create Custom Mix")
-                st.write("Select stems to include in your custom mix:")
-                
-                # Checkboxes for each stem
-                selected_stems = []
-                cols = st.columns(len(stem_paths))
-                for i, (stem_name, path) in enumerate(stem_paths.items()):
-                    with cols[i]:
-                        if st.checkbox(stem_name.capitalize(), value=True, key=f"include_{stem_name}"):
-                            selected_stems.append(stem_name)
-                
-                if st.button("Create Mix", key="create_mix_button"):
-                    if selected_stems:
-                        with st.spinner("Creating custom mix..."):
-                            # Create temporary file for mix
-                            mix_file = create_custom_mix(stem_paths, selected_stems)
-                            if mix_file:
-                                st.session_state["mix_file"] = mix_file
-                                st.success("Custom mix created!")
-                            else:
-                                st.error("Failed to create mix. Check the logs for details.")
-                
-                # Display custom mix if available
-                if "mix_file" in st.session_state and os.path.exists(st.session_state["mix_file"]):
-                    st.subheader("Custom Mix")
-                    try:
-                        st.audio(st.session_state["mix_file"], format="audio/wav")
-                    except Exception as e:
-                        st.warning(f"Could not play custom mix: {e}")
-                    
-                    st.write("Custom Mix Waveform:")
-                    st.pyplot(plot_waveform(st.session_state["mix_file"], "Custom Mix", "#9467bd"))
-                    
-                    # Add download button for the mix
-                    with open(st.session_state["mix_file"], "rb") as f:
-                        st.download_button(
-                            label="Download Custom Mix",
-                            data=f,
-                            file_name="custom_mix.wav",
-                            mime="audio/wav"
-                        )
+                show_custom_mix(stem_paths)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -6,39 +6,41 @@ import torch
 import os
 
 def generate_sine_wave(freq, duration, sample_rate):
-    """Generate a sine wave at given frequency, duration and sample rate."""
-    t = np.linspace(0, duration, int(sample_rate * duration), endpoint=False)
-    return np.sin(2 * np.pi * freq * t)
+    """
+    Generate a float32 sine wave at given frequency, duration and sample rate.
+    freq may also be an array of frequencies, giving one row per frequency.
+    """
+    t = np.linspace(0, duration, int(sample_rate * duration), endpoint=False, dtype=np.float32)
+    phases = 2 * np.pi * np.asarray(freq, dtype=np.float32)[..., None] * t
+    return np.sin(phases, out=phases)
 
 def generate_sample(output_path, sample_rate=44100, duration=10):
     """Generate a sample audio with multiple frequencies mixed together."""
     # Create directory if it doesn't exist
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     
-    # Generate sine waves at different frequencies (musical notes)
-    c_note = generate_sine_wave(261.63, duration, sample_rate)  # C4
-    e_note = generate_sine_wave(329.63, duration, sample_rate)  # E4
-    g_note = generate_sine_wave(392.00, duration, sample_rate)  # G4
-    
-    # Add a percussion-like element (pulsed noise)
-    percussion = np.zeros(int(sample_rate * duration))
-    for i in range(0, len(percussion), int(sample_rate * 0.5)):  # Every half second
-        if i + 2000 < len(percussion):
-            percussion[i:i+2000] = np.random.random(2000) * 0.2
-    
-    # Mix them together with different weights to simulate different instruments
-    mixed = c_note * 0.5 + e_note * 0.3 + g_note * 0.4 + percussion
+    # Generate all the tones at once: C4, E4, G4 and an A3 for the vocal-like part
+    tones = generate_sine_wave([261.63, 329.63, 392.00, 220.0], duration, sample_rate)
     
     # Add some amplitude modulation to simulate vocals
-    t = np.linspace(0, duration, int(sample_rate * duration), endpoint=False)
-    am = 0.5 + 0.5 * np.sin(2 * np.pi * 0.5 * t)  # Slow modulation
-    vocal_like = generate_sine_wave(220.0, duration, sample_rate) * am  # A3 with modulation
-    
-    # Final mix
-    final_mix = mixed * 0.8 + vocal_like * 0.4
+    t = np.linspace(0, duration, tones.shape[1], endpoint=False, dtype=np.float32)
+    tones[3] *= 0.5 + 0.5 * np.sin(2 * np.pi * 0.5 * t)  # Slow modulation
+    
+    # Mix them together with different weights to simulate different instruments;
+    # the instruments are scaled by 0.8 and the vocal by 0.4 in the final mix
+    weights = np.array([0.5 * 0.8, 0.3 * 0.8, 0.4 * 0.8, 0.4], dtype=np.float32)
+    final_mix = weights @ tones
+    
+    # Add a percussion-like element (pulsed noise every half second), scattered
+    # straight into the mix with one fancy-indexed update
+    pulse_length = 2000
+    starts = np.arange(0, len(final_mix), int(sample_rate * 0.5))
+    starts = starts[starts + pulse_length < len(final_mix)]
+    pulse_indices = starts[:, None] + np.arange(pulse_length)
+    final_mix[pulse_indices] += np.random.random(pulse_indices.shape).astype(np.float32) * (0.2 * 0.8)
     
     # Normalize
-    final_mix = final_mix / np.max(np.abs(final_mix))
+    final_mix /= np.max(np.abs(final_mix))
     
     # Convert to stereo
     stereo = np.vstack([final_mix, final_mix])
@@ -46,7 +48,7 @@ def generate_sample(output_path, sample_rate=44100, duration=10):
     # Save as WAV using torchaudio
     torchaudio.save(
         output_path, 
-        torch.tensor(stereo, dtype=torch.float32), 
+        torch.from_numpy(stereo), 
         sample_rate
     )
     
@@ -11,11 +11,13 @@ import os
 import sys
 import subprocess
 import argparse
-import tempfile
+import contextlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import torchaudio
 import numpy as np
-import librosa
+import soundfile as sf
 from pathlib import Path
 from demucs.pretrained import get_model
 from demucs.apply import apply_model
@@ -24,14 +26,44 @@ from demucs.audio import AudioFile
 # Configure default device (GPU if available, else CPU)
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
+# Files longer than LONG_FILE_SECONDS are separated in WINDOW_SECONDS windows, each with
+# CONTEXT_SECONDS of extra audio on both sides that is separated and then discarded
+LONG_FILE_SECONDS = 10 * 60
+WINDOW_SECONDS = 60
+CONTEXT_SECONDS = 5
+
+# Threads for writing stems; encoding and disk writes release the GIL
+IO_POOL = ThreadPoolExecutor(max_workers=4)
+
+# Resample transforms keyed by (source rate, target rate, device), so each filter kernel is only built once
+RESAMPLERS = {}
+
+def get_resampler(orig_sr, target_sr, device="cpu"):
+    """Return a cached Resample transform for the given rates on the given device."""
+    key = (orig_sr, target_sr, str(device))
+    if key not in RESAMPLERS:
+        RESAMPLERS[key] = torchaudio.transforms.Resample(orig_sr, target_sr).to(device)
+    return RESAMPLERS[key]
+
+@functools.lru_cache(maxsize=4)
+def load_model(model_name, device=DEVICE):
+    """Load a Demucs model onto a device once and reuse it for every later file."""
+    print(f"Loading Demucs model: {model_name}...")
+    model = get_model(model_name)
+    model.to(device)
+    model.eval()
+    return model
+
 def ensure_output_dir(output_dir):
     """Make sure the output directory exists."""
     os.makedirs(output_dir, exist_ok=True)
 
-def load_audio(input_file, target_sr=44100):
+def load_audio(input_file, target_sr=44100, device="cpu"):
     """
     Load audio file using multiple backends for better format support.
     Tries torchaudio first, then librosa as fallback.
+    The waveform is returned on `device`, and is moved there before resampling
+    so a GPU also does the resampling.
     """
     print(f"Loading audio file: {input_file}")
     
@@ -42,106 +74,179 @@ def load_audio(input_file, target_sr=44100):
     except Exception as e:
         print(f"torchaudio failed to load file, trying librosa: {e}")
         try:
+            # librosa is slow to import and only needed for formats torchaudio can't read
+            import librosa
+            
             # Second attempt: use librosa which supports more formats
             y, sample_rate = librosa.load(input_file, sr=None, mono=False)
-            # Librosa might return mono, reshape for stereo if needed
+            # Librosa might return mono; keep it as one channel, it is upmixed to a stereo view below
             if y.ndim == 1:
-                y = np.vstack([y, y])
-            waveform = torch.tensor(y)
+                y = y[np.newaxis]
+            waveform = torch.from_numpy(y)
             print(f"Successfully loaded with librosa: {input_file}")
         except Exception as e:
             # If the file is m4a, aac, or mp4, try converting it to wav first
             ext = os.path.splitext(input_file)[1].lower()
             if ext in ['.m4a', '.aac', '.mp4']:
-                print(f"Converting {ext} to temporary WAV for processing...")
+                print(f"Decoding {ext} with ffmpeg for processing...")
                 try:
-                    # Create a temp WAV file
-                    tmp_wav = tempfile.NamedTemporaryFile(suffix=".wav", delete=False).name
-                    
-                    # Try using subprocess with ffmpeg directly
+                    # Try using subprocess with ffmpeg directly, reading raw float32 PCM
+                    # from its stdout instead of round-tripping through a temp WAV
                     try:
-                        subprocess.run([
-                            "ffmpeg", "-y", "-i", input_file,
+                        result = subprocess.run([
+                            "ffmpeg", "-v", "quiet", "-i", input_file,
+                            "-f", "f32le", "-acodec", "pcm_f32le",
                             "-ar", str(target_sr), "-ac", "2",
-                            tmp_wav
-                        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                            "pipe:1"
+                        ], check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
                         
-                        # Now load the converted WAV
-                        waveform, sample_rate = torchaudio.load(tmp_wav)
+                        # Interleaved stereo frames -> (channels, samples)
+                        pcm = np.frombuffer(result.stdout, dtype=np.float32).reshape(-1, 2).T
+                        waveform = torch.from_numpy(pcm.copy())
+                        sample_rate = target_sr
                         print(f"Successfully converted and loaded: {input_file}")
-                        
-                        # Clean up temp file when done
-                        os.remove(tmp_wav)
                     except Exception as ffmpeg_error:
                         # If subprocess approach fails, try librosa which can handle more formats
                         print(f"FFmpeg conversion failed: {ffmpeg_error}, trying librosa...")
                         y, sample_rate = librosa.load(input_file, sr=target_sr, mono=False)
                         if y.ndim == 1:
-                            y = np.vstack([y, y])
-                        waveform = torch.tensor(y)
+                            y = y[np.newaxis]
+                        waveform = torch.from_numpy(y)
                         print(f"Successfully loaded with librosa: {input_file}")
                 except Exception as conversion_error:
                     raise RuntimeError(f"All attempts to load audio file failed: {conversion_error}")
             else:
                 raise RuntimeError(f"Could not load audio file: {e}")
     
+    return prepare_waveform(waveform, sample_rate, target_sr, device), target_sr
+
+def prepare_waveform(waveform, sample_rate, target_sr, device="cpu", verbose=True):
+    """
+    Turn a decoded (channels, samples) waveform into model input: stereo, at target_sr, on `device`.
+    The waveform is moved to the device before resampling so a GPU also does the resampling.
+    """
+    # Copy to the GPU from pinned memory, so the transfer doesn't have to be staged
+    if str(device).startswith("cuda"):
+        waveform = waveform.pin_memory().to(device, non_blocking=True)
+    
     # Resample if needed
     if sample_rate != target_sr:
-        print(f"Resampling from {sample_rate}Hz to {target_sr}Hz")
-        resampler = torchaudio.transforms.Resample(sample_rate, target_sr)
-        waveform = resampler(waveform)
+        if verbose:
+            print(f"Resampling from {sample_rate}Hz to {target_sr}Hz")
+        waveform = get_resampler(sample_rate, target_sr, waveform.device)(waveform)
     
     # Check channel configuration
     if waveform.shape[0] > 2:
-        print(f"Audio has {waveform.shape[0]} channels, truncating to stereo")
+        if verbose:
+            print(f"Audio has {waveform.shape[0]} channels, truncating to stereo")
         waveform = waveform[:2]  # Take first two channels only
     
     # Make stereo if mono
     if waveform.shape[0] == 1:
-        print("Converting mono to stereo")
-        waveform = torch.cat([waveform, waveform], dim=0)
+        if verbose:
+            print("Converting mono to stereo")
+        waveform = waveform.expand(2, -1)  # a view, no duplicate buffer
     
-    return waveform, target_sr
+    return waveform
 
-def save_audio(audio, path, sample_rate):
-    """Save audio array to a file using torchaudio."""
-    # Normalize if float and outside [-1, 1]
-    if np.issubdtype(audio.dtype, np.floating) and np.max(np.abs(audio)) > 1:
-        audio = audio / np.max(np.abs(audio)) * 0.9
-    
-    # Convert to torch tensor if numpy array
-    if isinstance(audio, np.ndarray):
-        audio = torch.from_numpy(audio)
+def save_audio(audio, path, sample_rate, make_dirs=True):
+    """
+    Save a (channels, samples) audio array or tensor to a 16-bit PCM WAV file with soundfile.
+    Pass make_dirs=False when the caller has already created the parent directory.
+    """
+    # soundfile writes numpy arrays
+    if isinstance(audio, torch.Tensor):
+        audio = audio.detach().cpu().numpy()
     
-    # Ensure it's float32 for torchaudio
-    audio = audio.to(torch.float32)
+    # Normalize if float and outside [-1, 1], scanning for the peak only once
+    if np.issubdtype(audio.dtype, np.floating):
+        peak = float(np.abs(audio).max(initial=0.0))
+        if peak > 1:
+            audio = audio * (0.9 / peak)
     
     # Ensure parent directory exists
-    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if make_dirs:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
     
-    # Save audio with backend specification to avoid errors
+    # Write a new file rather than overwriting in place, so hardlinked copies of an
+    # earlier stem (e.g. the app's stem cache) are left untouched.
+    # Read-only files can't be removed on Windows, so make the old file writable first
+    if os.path.exists(path):
+        os.chmod(path, 0o644)
+        os.remove(path)
+    
+    # 16-bit PCM is the usual format for stems and half the size of float32.
+    # soundfile wants (samples, channels)
+    sf.write(path, audio.T, sample_rate, subtype="PCM_16")
+
+def run_model(model, audio, device, half_precision=True, **apply_options):
+    """Run Demucs on a (channels, samples) waveform and return the (sources, channels, samples) stems."""
+    # Autocast only covers the model's layers; Demucs still overlap-adds the segments
+    # into a float32 output, so the stems keep full precision
+    # A disabled CUDA autocast still warns on CPU-only builds, so only build it when it's used
+    use_autocast = half_precision and str(device).startswith("cuda")
+    autocast = torch.autocast("cuda", dtype=torch.float16) if use_autocast else contextlib.nullcontext()
+    with torch.inference_mode(), autocast:
+        # Make the batch contiguous once up front; a no-op unless the input is a mono view
+        return apply_model(model, audio.unsqueeze(0).contiguous(), device=device, **apply_options)[0]
+
+def is_long_file(input_file):
+    """Whether the file is long enough to separate in windows; only files soundfile can seek in qualify."""
     try:
-        torchaudio.save(path, audio, sample_rate, backend="soundfile")
-    except Exception as e:
-        print(f"Error with soundfile backend: {e}, trying default backend")
+        return sf.info(input_file).duration > LONG_FILE_SECONDS
+    except RuntimeError:
+        return False
+
+def separate_in_windows(input_file, stem_paths, model, device, half_precision=True, **apply_options):
+    """
+    Separate a long file window by window, appending each window's stems to their files,
+    so neither the whole track nor its stems are ever held in memory.
+    Each window is separated with CONTEXT_SECONDS of the neighbouring audio on both sides,
+    which is then discarded, so the window edges don't leave seams in the stems.
+    The stems are clipped to [-1, 1] rather than peak-normalized, as the peak isn't known up front.
+    """
+    with sf.SoundFile(input_file) as f:
+        # Windows are whole seconds, so they map to an exact number of frames at either sample rate
+        input_sr = f.samplerate
+        window = WINDOW_SECONDS * input_sr
+        context = CONTEXT_SECONDS * input_sr
+        
+        writers = {}
         try:
-            torchaudio.save(path, audio, sample_rate)
-        except Exception as e2:
-            print(f"Error saving audio: {e2}")
-            # Last resort: Use scipy to save if torchaudio fails
-            try:
-                from scipy.io import wavfile
-                # Convert to numpy for scipy
-                audio_np = audio.cpu().numpy()
-                # Normalize to int16 range
-                if audio_np.dtype != np.int16:
-                    audio_np = (audio_np * 32767).astype(np.int16)
-                wavfile.write(path, sample_rate, audio_np.T)  # scipy wants (samples, channels)
-                print(f"Audio saved using scipy.io.wavfile: {path}")
-            except Exception as e3:
-                raise RuntimeError(f"All attempts to save audio failed: {e3}")
+            for stem_name, stem_path in stem_paths.items():
+                # Write new files, so hardlinked copies of earlier stems are left untouched
+                if os.path.exists(stem_path):
+                    os.remove(stem_path)
+                writers[stem_name] = sf.SoundFile(stem_path, "w", samplerate=model.samplerate,
+                                                  channels=2, subtype="PCM_16")
+            
+            for start in range(0, f.frames, window):
+                stop = min(start + window, f.frames)
+                read_start = max(start - context, 0)
+                f.seek(read_start)
+                chunk = f.read(min(stop + context, f.frames) - read_start, dtype="float32", always_2d=True)
+                print(f"  - Separating {start / input_sr:.0f}s to {stop / input_sr:.0f}s")
+                
+                audio = prepare_waveform(torch.from_numpy(chunk.T), input_sr, model.samplerate,
+                                         device, verbose=False)
+                stems = run_model(model, audio, device, half_precision, **apply_options)
+                
+                # Keep only this window's part of the separated audio
+                head = (start - read_start) * model.samplerate // input_sr
+                length = round((stop - start) * model.samplerate / input_sr)
+                stems = stems[..., head:head + length].cpu().numpy()
+                np.clip(stems, -1, 1, out=stems)
+                for stem_idx, stem_name in enumerate(model.sources):
+                    writers[stem_name].write(stems[stem_idx].T)
+        finally:
+            for writer in writers.values():
+                writer.close()
+    
+    for stem_name, stem_path in stem_paths.items():
+        print(f"  - Saved {stem_name} stem to {stem_path}")
 
-def separate_audio(input_file, output_dir, model_name="htdemucs", device=DEVICE):
+def separate_audio(input_file, output_dir, model_name="htdemucs", device=DEVICE, model=None,
+                   shifts=1, overlap=0.25, num_workers=0, half_precision=True, return_stems=False):
     """
     Separate audio into stems using Demucs.
     
@@ -150,48 +255,93 @@ def separate_audio(input_file, output_dir, model_name="htdemucs", device=DEVICE)
         output_dir: Directory to save stems
         model_name: Demucs model variant to use (default: htdemucs - Hybrid Transformer Demucs)
         device: Computation device ('cpu' or 'cuda')
+        model: Already loaded Demucs model on `device`; loaded from model_name if not given
+        shifts: Number of random time shifts to average over (0 disables shifting, more is slower but cleaner)
+        overlap: Fraction of overlap between consecutive segments
+        num_workers: Worker threads Demucs uses to process segments in parallel on CPU
+        half_precision: Run the model under float16 autocast when on CUDA
+        return_stems: Also return the separated audio, so callers can use it without reading the files back
     
     Returns:
-        Dictionary mapping stem names to their file paths
+        Dictionary mapping stem names to their file paths. With return_stems, a tuple of
+        (that dictionary, stems tensor of shape (sources, channels, samples) on `device`, sample rate)
     """
     ensure_output_dir(output_dir)
     
-    # Load the model
-    print(f"Loading Demucs model: {model_name}...")
-    model = get_model(model_name)
-    model.to(device)
+    # Load the model unless a preloaded one was passed in
+    if model is None:
+        model = load_model(model_name, device)
+    
+    # Get output file base name without extension
+    base_name = os.path.splitext(os.path.basename(input_file))[0]
+    output_folder = os.path.join(output_dir, base_name)
+    ensure_output_dir(output_folder)
+    
+    # Long files are separated window by window instead of being decoded whole
+    if not return_stems and is_long_file(input_file):
+        print(f"Separating long file in {WINDOW_SECONDS} second windows with Demucs {model_name} on {device}...")
+        stem_paths = {stem_name: os.path.join(output_folder, f"{stem_name}.wav") for stem_name in model.sources}
+        separate_in_windows(input_file, stem_paths, model, device, half_precision, shifts=shifts,
+                            overlap=overlap, num_workers=num_workers)
+        return stem_paths
     
     # Load audio directly with our enhanced loading function
     try:
-        audio, sr = load_audio(input_file, model.samplerate)
-        audio = audio.to(device)
+        audio, sr = load_audio(input_file, model.samplerate, device)
     except Exception as e:
         print(f"Error loading audio: {e}")
         print("Make sure the file exists and is a valid audio format.")
-        return {}
+        return ({}, None, None) if return_stems else {}
     
     # Apply the model
     print(f"Separating stems with Demucs {model_name} on {device}...")
-    stems = apply_model(model, audio.unsqueeze(0), device=device)[0]
-    
-    # Get output file base name without extension
-    base_name = os.path.splitext(os.path.basename(input_file))[0]
-    output_folder = os.path.join(output_dir, base_name)
-    ensure_output_dir(output_folder)
+    stems = run_model(model, audio, device, half_precision, shifts=shifts,
+                      overlap=overlap, num_workers=num_workers)
     
-    # Save each stem
+    # Save each stem in parallel, after copying all of them off the device in one transfer
     stem_paths = {}
     print(f"Saving separated stems to {output_folder}...")
     
+    stems_cpu = stems.cpu().numpy()
+    saves = {}
     for stem_idx, stem_name in enumerate(model.sources):
         stem_path = os.path.join(output_folder, f"{stem_name}.wav")
-        stem_audio = stems[stem_idx].cpu().numpy()
-        save_audio(stem_audio, stem_path, model.samplerate)
+        saves[stem_name] = IO_POOL.submit(save_audio, stems_cpu[stem_idx], stem_path, model.samplerate, make_dirs=False)
         stem_paths[stem_name] = stem_path
-        print(f"  - Saved {stem_name} stem to {stem_path}")
     
+    for stem_name, save in saves.items():
+        save.result()
+        print(f"  - Saved {stem_name} stem to {stem_paths[stem_name]}")
+    
+    if return_stems:
+        return stem_paths, stems, model.samplerate
     return stem_paths
 
+def mix_stem_tensors(stems, sources, include_list, output_path, sample_rate):
+    """
+    Mix selected stems straight from separated audio, without reading stem files back.
+    
+    Args:
+        stems: Tensor of shape (sources, channels, samples), as returned by separate_audio
+        sources: Stem names in the order of the first dimension of stems
+        include_list: List of stem names to include in the mix
+        output_path: Path to save the mixed audio
+        sample_rate: Sample rate of the stems
+    """
+    indices = [sources.index(stem_name) for stem_name in include_list if stem_name in sources]
+    if not indices:
+        return None
+    
+    # Sum on whatever device the stems are on, then normalize to prevent clipping
+    mixed = stems[indices].sum(dim=0)
+    peak = mixed.abs().max()
+    if peak > 0:
+        mixed.mul_(0.9 / peak)
+    
+    save_audio(mixed.cpu().numpy(), output_path, sample_rate)
+    print(f"Mixed audio saved to {output_path}")
+    return output_path
+
 def mix_stems(stem_paths, output_path, include_list=None):
     """
     Mix selected stems into a single audio file.
@@ -205,24 +355,29 @@ def mix_stems(stem_paths, output_path, include_list=None):
     if not include_list:
         return None
     
-    mixed = None
+    # Decode the selected stems in parallel
+    loads = {}
     for stem_name in include_list:
         if stem_name in stem_paths:
             print(f"Adding {stem_name} to mix...")
-            try:
-                waveform, sr = torchaudio.load(stem_paths[stem_name])
-                
-                if mixed is None:
-                    mixed = waveform
-                else:
-                    mixed = mixed + waveform
-            except Exception as e:
-                print(f"Error loading {stem_name} for mixing: {e}")
+            loads[stem_name] = IO_POOL.submit(torchaudio.load, stem_paths[stem_name])
+    
+    waveforms = []
+    for stem_name, load in loads.items():
+        try:
+            waveform, sr = load.result()
+            waveforms.append(waveform)
+        except Exception as e:
+            print(f"Error loading {stem_name} for mixing: {e}")
+    
+    # Sum all stems in a single reduction instead of one new tensor per stem
+    mixed = torch.stack(waveforms).sum(dim=0) if waveforms else None
     
     if mixed is not None:
         # Normalize to prevent clipping
-        if mixed.abs().max() > 0:
-            mixed = mixed / mixed.abs().max() * 0.9
+        peak = mixed.abs().max()
+        if peak > 0:
+            mixed.mul_(0.9 / peak)
         
         # Create directory if it doesn't exist
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
@@ -247,7 +402,7 @@ def mix_stems(stem_paths, output_path, include_list=None):
 
 def create_stem_mix(input_file, output_dir, output_name="custom_mix.wav", 
                    vocals=True, drums=True, bass=True, other=True,
-                   model_name="htdemucs", device=DEVICE):
+                   model_name="htdemucs", device=DEVICE, **separation_options):
     """
     Create a custom mix by including or excluding stems.
     
@@ -258,25 +413,21 @@ def create_stem_mix(input_file, output_dir, output_name="custom_mix.wav",
         vocals/drums/bass/other: Whether to include each stem
         model_name: Demucs model to use
         device: Computation device
+        separation_options: Extra keyword arguments for separate_audio (model, shifts, overlap, num_workers)
     
     Returns:
         Path to the created mix file
     """
-    # First separate the audio
-    stem_paths = separate_audio(input_file, output_dir, model_name, device)
+    # First separate the audio, keeping the stems in memory for the mix
+    stem_paths, stems, sample_rate = separate_audio(input_file, output_dir, model_name, device,
+                                                    return_stems=True, **separation_options)
     if not stem_paths:
         return None
     
     # Determine which stems to include
-    stems_to_mix = []
-    if vocals and "vocals" in stem_paths:
-        stems_to_mix.append("vocals")
-    if drums and "drums" in stem_paths:
-        stems_to_mix.append("drums")
-    if bass and "bass" in stem_paths:
-        stems_to_mix.append("bass")
-    if other and "other" in stem_paths:
-        stems_to_mix.append("other")
+    # Stems without a flag (e.g. guitar and piano from 6-stem models) are always included
+    flags = {"vocals": vocals, "drums": drums, "bass": bass, "other": other}
+    stems_to_mix = [stem_name for stem_name in stem_paths if flags.get(stem_name, True)]
     
     # Get base folder path and create mix output path
     base_name = os.path.splitext(os.path.basename(input_file))[0]
@@ -284,17 +435,24 @@ def create_stem_mix(input_file, output_dir, output_name="custom_mix.wav",
     mix_path = os.path.join(output_folder, output_name)
     
     # Mix the stems
-    return mix_stems(stem_paths, mix_path, stems_to_mix)
+    return mix_stem_tensors(stems, list(stem_paths), stems_to_mix, mix_path, sample_rate)
 
 def main():
     parser = argparse.ArgumentParser(
         description="Separate audio into stems using Demucs"
     )
-    parser.add_argument("input_file", help="Path to audio file (mp3/m4a/wav/...)")
+    parser.add_argument("input_files", nargs="+", metavar="input_file",
+                       help="Path to audio file(s) (mp3/m4a/wav/...)")
     parser.add_argument("output_dir", help="Where to save stems")
     parser.add_argument("--model", choices=["htdemucs", "htdemucs_ft", "mdx_extra", "mdx_extra_q"], 
                        default="htdemucs", help="Demucs model to use")
     parser.add_argument("--cpu", action="store_true", help="Force CPU processing")
+    parser.add_argument("--shifts", type=int, default=1,
+                       help="Random time shifts to average over; 0 is fastest")
+    parser.add_argument("--overlap", type=float, default=0.25,
+                       help="Overlap between segments; lower is faster")
+    parser.add_argument("-j", "--jobs", type=int, default=0,
+                       help="Worker threads for processing segments in parallel on CPU")
     parser.add_argument("--mix", action="store_true", help="Create a custom mix")
     parser.add_argument("--no-vocals", action="store_true", help="Exclude vocals from mix")
     parser.add_argument("--no-drums", action="store_true", help="Exclude drums from mix")
@@ -305,22 +463,32 @@ def main():
     
     # Set device
     device = "cpu" if args.cpu else DEVICE
+    separation_options = {
+        "shifts": args.shifts,
+        "overlap": args.overlap,
+        "num_workers": args.jobs
+    }
+    
+    # Load the model once and reuse it for every input file
+    separation_options["model"] = load_model(args.model, device)
     
-    if args.mix:
-        # Create custom mix
-        create_stem_mix(
-            args.input_file, 
-            args.output_dir,
-            vocals=not args.no_vocals,
-            drums=not args.no_drums,
-            bass=not args.no_bass,
-            other=not args.no_other,
-            model_name=args.model,
-            device=device
-        )
-    else:
-        # Simply separate
-        separate_audio(args.input_file, args.output_dir, args.model, device)
+    for input_file in args.input_files:
+        if args.mix:
+            # Create custom mix
+            create_stem_mix(
+                input_file, 
+                args.output_dir,
+                vocals=not args.no_vocals,
+                drums=not args.no_drums,
+                bass=not args.no_bass,
+                other=not args.no_other,
+                model_name=args.model,
+                device=device,
+                **separation_options
+            )
+        else:
+            # Simply separate
+            separate_audio(input_file, args.output_dir, args.model, device, **separation_options)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file